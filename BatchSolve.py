@@ -0,0 +1,241 @@
+import argparse
+import json
+import os
+import pickle
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from Solution import load_images, find_diff, make_key, crack, apply_map, FitnessCache
+
+"""
+Decodes and cracks a whole directory of encoded images against their originals. Images are read in and diffed on a pool
+of threads (a few pairs ahead of the crackers) and the cracking is done on a pool of processes. Results are
+written out as they finish, one JSON object per line.
+"""
+
+ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ !,."
+# The colours for " " and "E" from main.py's map, same as the guesses in Solution.py
+GUESSES = {(1, 0, 0, 7): " ", (2, 0, 0, 19): "E"}
+
+# The language model, loaded once in each worker process by init_worker
+text_freqs = None
+
+
+def init_worker(language_freqs):
+    """
+    Runs once in each worker process so the bigram table only gets sent over once, not with every pair
+    """
+    global text_freqs
+    text_freqs = language_freqs
+
+
+def find_pairs(encoded_dir, original_dir):
+    """
+    Matches each encoded image to the original with the same file name (ignoring the extension). Returns a list of
+    (encoded, original) paths
+    """
+    originals = {}
+    for fn in sorted(os.listdir(original_dir)):
+        stem = os.path.splitext(fn)[0]
+        originals.setdefault(stem, os.path.join(original_dir, fn))
+
+    pairs = []
+    for fn in sorted(os.listdir(encoded_dir)):
+        stem = os.path.splitext(fn)[0]
+        if stem in originals:
+            pairs.append((os.path.join(encoded_dir, fn), originals[stem]))
+        else:
+            print(f"No original found for {fn}, skipping")
+
+    return pairs
+
+
+def read_done(out_fn):
+    """
+    Returns the encoded images that already have a result in the output file, so a rerun can skip them. Pairs that
+    errored don't count, so they get another go
+    """
+    done = set()
+    if not os.path.exists(out_fn):
+        return done
+
+    with open(out_fn, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue    # half written line from a killed run
+
+            if "encoded" in record and "error" not in record:
+                done.add(record["encoded"])
+
+    return done
+
+
+def pair_seed(seed, enc_fn):
+    """
+    Gives each image its own seed based on its file name, so it gets the same result whatever else is in the batch
+    """
+    return (seed + zlib.crc32(os.path.basename(enc_fn).encode())) % 2**32
+
+
+def load_diff(enc_fn, orig_fn):
+    """
+    Reads in a pair and finds the changed pixels. Runs on the I/O threads so only the (small) list of colours gets
+    sent to the worker processes, not the whole images
+    """
+    return find_diff(*load_images(enc_fn, orig_fn))
+
+
+def crack_pair(enc_fn, orig_fn, colours, seed, max_iterations, max_count, checkpoint_file):
+    """
+    Cracks the changed pixels of one pair. Runs in a worker process
+    """
+    np.random.seed(seed)
+
+    key = make_key(ALPHABET, colours, guesses=GUESSES)
+    cache = FitnessCache(colours)
+    best_key, best_fitness = crack(colours, text_freqs, key,
+                                   max_iterations=max_iterations,
+                                   max_count=max_count,
+                                   checkpoint_file=checkpoint_file,
+                                   resume=checkpoint_file is not None,
+                                   verbose=False,
+                                   cache=cache)
+
+    return {"encoded": enc_fn,
+            "original": orig_fn,
+            "pixels": len(colours),
+            "fitness": float(best_fitness),
+            "key": {",".join(map(str, colour)): letter for colour, letter in best_key.items()},
+            "message": apply_map(colours, best_key),
+            "cache": {"hits": cache.hits, "misses": cache.misses, "noops": cache.noops}}
+
+
+def run_batch(pairs, out_fn, language_freqs, workers=None, io_workers=4, prefetch=8, seed=1337,
+              max_iterations=40000, max_count=5000, checkpoint_dir=None):
+    """
+    Streams the (encoded, original) pairs through the thread and process pools and appends a line to out_fn
+    for each pair as soon as it is done. At most prefetch pairs are read in ahead of the crackers, and only their
+    changed pixels are kept and sent to the workers, so memory stays bounded. Stops early if a worker process dies
+    """
+    workers = workers or os.cpu_count()
+    pairs = iter(pairs)
+    loading = {}            # future: paths, in the order they were read
+    cracking = {}           # future: paths
+
+    def queue_loads():
+        while len(loading) < prefetch:
+            pair = next(pairs, None)
+            if pair is None:
+                return
+            loading[io_pool.submit(load_diff, *pair)] = pair
+
+    def write(record):
+        out.write(json.dumps(record) + "\n")
+        out.flush()
+
+    with ThreadPoolExecutor(io_workers) as io_pool, \
+            ProcessPoolExecutor(workers, initializer=init_worker, initargs=(language_freqs,)) as cpu_pool, \
+            open(out_fn, 'a', encoding='utf-8') as out:
+
+        queue_loads()
+        broken = False
+
+        while (loading or cracking) and not broken:
+            # Hand any pairs that have been read in over to the crackers, with a couple queued up per worker so
+            # they never sit idle. A slow read doesn't hold up the ones behind it
+            for future in [f for f in loading if f.done()]:
+                if len(cracking) >= 2 * workers:
+                    break
+
+                enc_fn, orig_fn = loading.pop(future)
+                try:
+                    colours = future.result()
+                except Exception as e:
+                    write({"encoded": enc_fn, "original": orig_fn, "error": repr(e)})
+                    continue
+
+                checkpoint_file = None
+                if checkpoint_dir:
+                    checkpoint_file = os.path.join(checkpoint_dir, f"{os.path.basename(enc_fn)}.pkl")
+
+                try:
+                    future = cpu_pool.submit(crack_pair, enc_fn, orig_fn, colours, pair_seed(seed, enc_fn),
+                                             max_iterations, max_count, checkpoint_file)
+                except BrokenProcessPool:
+                    broken = True
+                    break
+
+                cracking[future] = (enc_fn, orig_fn)
+
+            queue_loads()
+            if broken:
+                break
+
+            # Wait for the next crack or read to finish. Reads only count if there's room to hand them over
+            waiting = list(cracking)
+            if len(cracking) < 2 * workers:
+                waiting += list(loading)
+
+            done, _ = wait(waiting, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future not in cracking:
+                    continue    # a read, handed over next time round
+
+                enc_fn, orig_fn = cracking.pop(future)
+                try:
+                    record = future.result()
+                except BrokenProcessPool:
+                    # Not this pair's fault, so don't write an error for it. It gets picked up on the next run
+                    broken = True
+                    continue
+                except Exception as e:
+                    record = {"encoded": enc_fn, "original": orig_fn, "error": repr(e)}
+
+                write(record)
+                print(f"Finished {record['encoded']}")
+
+        if broken:
+            for future in loading:
+                future.cancel()
+            print("A worker process died, stopping. Rerun to pick up the pairs that didn't finish")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decode and crack a directory of encoded images")
+    parser.add_argument("encoded_dir", help="folder of encoded images")
+    parser.add_argument("original_dir", help="folder of original images, matched to the encoded ones by name")
+    parser.add_argument("--out", default="results.jsonl", help="JSON lines file to append results to")
+    parser.add_argument("--freqs", default="bigram_freqs.pkl", help="bigram frequency table")
+    parser.add_argument("--workers", type=int, default=None, help="cracking processes, defaults to the cpu count")
+    parser.add_argument("--io-workers", type=int, default=4, help="threads reading in images")
+    parser.add_argument("--prefetch", type=int, default=8, help="max pairs read in ahead of the crackers")
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--max-iterations", type=int, default=40000)
+    parser.add_argument("--max-count", type=int, default=5000)
+    parser.add_argument("--checkpoint-dir", default=None, help="save and resume each crack from this folder")
+    args = parser.parse_args()
+
+    with open(args.freqs, 'rb') as f:
+        freqs = pickle.load(f)
+
+    if args.checkpoint_dir:
+        os.makedirs(args.checkpoint_dir, exist_ok=True)
+
+    # Skip anything that finished on a previous run
+    done = read_done(args.out)
+    pairs = [pair for pair in find_pairs(args.encoded_dir, args.original_dir) if pair[0] not in done]
+    print(f"Cracking {len(pairs)} images ({len(done)} already done)")
+
+    run_batch(pairs, args.out, freqs,
+              workers=args.workers,
+              io_workers=args.io_workers,
+              prefetch=args.prefetch,
+              seed=args.seed,
+              max_iterations=args.max_iterations,
+              max_count=args.max_count,
+              checkpoint_dir=args.checkpoint_dir)
@@ -0,0 +1,194 @@
+import os
+import pickle
+from math import floor
+from Modulator_RGBA import Modulator
+from MapCreator import *
+from PIL import Image
+from functools import reduce
+
+"""
+Changes the message in an image that has already been encoded by main.py, without re-encoding the whole thing.
+Works out which of the chosen pixels end up with a different colour (or are new, or no longer used) and only
+rewrites those.
+
+main.py sorts the chosen pixels and writes the symbols into them in order, so a longer message doesn't just add
+pixels on the end - every new pixel shifts the symbols after it along by one. Pixels that happen to keep the
+same symbol are left alone, but appending to the message still rewrites most of the pixels (about 92% when adding
+a tail to longer_message.txt). Editing characters in place only touches the pixels for those characters.
+"""
+
+# These need to be the same as when the image was encoded with main.py
+CHANNEL_WIDTH = [200, 100, 100, 100]
+SYMBOL_LENGTH = 8
+SEED = 1337
+MAP_FILE = None     # A pickled map to load instead of rebuilding it from the channel width
+
+ENCODED_IMAGE = "EncodedImage.png"
+ORIGINAL_IMAGE = 'time_travel_image.jpg'    # Only read in if some pixels can't be undone from the encoded image
+OLD_MESSAGE = "longer_message.txt"
+NEW_MESSAGE = "new_message.txt"
+OUTPUT = "EncodedImage_updated.png"     # Keep this different to ENCODED_IMAGE, or OLD_MESSAGE won't match it anymore
+
+
+def choose_pixels(n_pixels, n_symbols, seed):
+    """
+    Picks the same pixels main.py does for a message of n_symbols, in ascending order
+    """
+    np.random.seed(seed)
+    chosen_pixels = np.random.choice(n_pixels, n_symbols, replace=False)
+    chosen_pixels.sort()
+
+    return chosen_pixels
+
+
+def modulate(message_file, symbol_length, rgba_map, n_pixels):
+    """
+    Turns a message into an (n, 4) int16 array of colours, trimmed down to the number of pixels like main.py
+    """
+    mod = Modulator(file=message_file,
+                    symbol_len=symbol_length,
+                    rgba_map=rgba_map)
+
+    return np.array(mod.message_modulated[0:n_pixels], dtype=np.int16).reshape((-1, 4))
+
+
+def write_symbols(pixels, colours):
+    """
+    Adds the colours to the pixels, subtracting instead for any channel that would go over 255 (same as main.py)
+    """
+    summed = pixels + colours
+    return np.where(summed > 255, pixels - colours, summed)
+
+
+def undo_symbols(pixels, colours):
+    """
+    Works out what the pixels were before the colours were written into them. Returns the original pixels and a
+    mask of the pixels where that can't be told from the encoded pixel alone.
+
+    A channel that was added to can be undone if the result is >= 0, one that was subtracted from can be undone if
+    the original + colour would have gone over 255. Sometimes both are possible, so those pixels are ambiguous.
+    The alpha channel is always 255 in the original (main.py uses putalpha(255)), so that one is always known
+    """
+    added = pixels - colours >= 0
+    subtracted = (pixels + colours <= 255) & (pixels + 2 * colours > 255)
+
+    if np.any(~added & ~subtracted) or np.any(pixels[:, 3] != 255 - colours[:, 3]):
+        raise ValueError("Encoded image doesn't match the old message. Check the seed, map and message")
+
+    originals = np.where(added, pixels - colours, pixels + colours)
+    originals[:, 3] = 255
+    ambiguous = np.any(added[:, :3] & subtracted[:, :3], axis=1)
+
+    return originals, ambiguous
+
+
+def plan_update(old_pixels, old_msg, new_pixels, new_msg):
+    """
+    Compares the old and new (pixel, colour) pairs. Returns the pixels that need restoring to the original image
+    (with the colour currently in them), and the pixels that need writing (with the colour that was in them, or -1
+    if they're untouched, and the new colour)
+    """
+    # Pixels used by both messages, only worth rewriting if the symbol changed
+    _, old_inds, new_inds = np.intersect1d(old_pixels, new_pixels, assume_unique=True, return_indices=True)
+    changed = np.any(old_msg[old_inds] != new_msg[new_inds], axis=1)
+    old_inds, new_inds = old_inds[changed], new_inds[changed]
+
+    # Pixels the old message used but the new one doesn't
+    dropped = ~np.isin(old_pixels, new_pixels, assume_unique=True)
+    # Pixels the new message uses that haven't been written to yet
+    added = ~np.isin(new_pixels, old_pixels, assume_unique=True)
+
+    restore_pixels = old_pixels[dropped]
+    restore_msg = old_msg[dropped]
+
+    write_pixels = np.concatenate([new_pixels[new_inds], new_pixels[added]])
+    write_old_msg = np.concatenate([old_msg[old_inds], np.full((added.sum(), 4), -1, dtype=np.int16)])
+    write_new_msg = np.concatenate([new_msg[new_inds], new_msg[added]])
+
+    return restore_pixels, restore_msg, write_pixels, write_old_msg, write_new_msg
+
+
+def update_image(enc_img, old_msg, new_msg, seed, original_file):
+    """
+    Rewrites the pixels of a flat (n, 4) int16 encoded image so it holds the new message instead of the old one.
+    Changes the image in place and returns the number of pixels touched and how many of them needed the original
+    image
+    """
+    n_pixels = enc_img.shape[0]
+    old_pixels = choose_pixels(n_pixels, len(old_msg), seed)
+    new_pixels = choose_pixels(n_pixels, len(new_msg), seed)
+
+    restore_pixels, restore_msg, write_pixels, write_old_msg, write_new_msg = plan_update(old_pixels, old_msg,
+                                                                                           new_pixels, new_msg)
+
+    # Get back the original pixel values. Pixels that haven't been written to are still the original
+    pixels = np.concatenate([restore_pixels, write_pixels])
+    msg = np.concatenate([restore_msg, write_old_msg])
+    untouched = msg[:, 0] < 0
+    msg[untouched] = 0
+
+    originals, ambiguous = undo_symbols(enc_img[pixels], msg)
+    ambiguous &= ~untouched
+
+    # Anything that can't be undone from the encoded image has to come from the original
+    if np.any(ambiguous):
+        print(f"Reading in the original image for {ambiguous.sum()} ambiguous pixels")
+        orig_img = Image.open(original_file)
+        orig_img.putalpha(255)
+        orig_img = np.array(orig_img, dtype=np.int16).reshape((-1, 4))
+        originals[ambiguous] = orig_img[pixels[ambiguous]]
+
+    # Dropped pixels go back to the original, the rest get the new symbol
+    n_restore = len(restore_pixels)
+    updated = originals.copy()
+    updated[n_restore:] = write_symbols(originals[n_restore:], write_new_msg)
+
+    # Only count the pixels that actually end up a different colour
+    touched = np.any(updated != enc_img[pixels], axis=1)
+    enc_img[pixels[touched]] = updated[touched]
+
+    return int(touched.sum()), int(ambiguous.sum())
+
+
+if __name__ == "__main__":
+    # Check for the messages before doing any of the slow stuff
+    for message_file in [OLD_MESSAGE, NEW_MESSAGE]:
+        if not os.path.exists(message_file):
+            raise FileNotFoundError(f"Couldn't find {message_file}, set OLD_MESSAGE and NEW_MESSAGE at the top")
+
+    # Rebuild the modulating map the same way main.py does
+    max_space = reduce(lambda x, y: x * y, CHANNEL_WIDTH)
+    symbol_length = floor(log2(max_space))
+    symbol_length = min(symbol_length, SYMBOL_LENGTH)
+
+    if MAP_FILE:
+        with open(MAP_FILE, 'rb') as f:
+            modulating_map = pickle.load(f)
+    else:
+        print("Creating the modulating map")
+        modulating_map = create_rgba_map(n=2**symbol_length,
+                                         channel_width=CHANNEL_WIDTH,
+                                         mode="safe")
+
+    print("Reading in the encoded image")
+    image = np.array(Image.open(ENCODED_IMAGE).convert("RGBA"))
+    image_shape = image.shape
+    img_16 = image.astype(np.int16).reshape((-1, 4))
+    n_pixels = img_16.shape[0]
+
+    old_msg = modulate(OLD_MESSAGE, symbol_length, modulating_map, n_pixels)
+    new_msg = modulate(NEW_MESSAGE, symbol_length, modulating_map, n_pixels)
+
+    print("Updating the message")
+    touched, from_original = update_image(img_16, old_msg, new_msg, SEED, ORIGINAL_IMAGE)
+
+    # A full re-encode with main.py writes every chosen pixel
+    print(f"Touched {touched} pixels, a full re-encode writes {len(new_msg)} "
+          f"({touched / max(len(new_msg), 1):.1%}). {from_original} of them needed the original image")
+
+    if len(new_msg) != len(old_msg):
+        print("The message length changed, so the symbols after each new or dropped pixel shifted along "
+              "(main.py writes symbols into the pixels in sorted order) and most pixels had to be rewritten")
+
+    img_16 = img_16.astype(np.uint8).reshape(image_shape)
+    Image.fromarray(img_16, "RGBA").save(OUTPUT)
@@ -1,9 +1,11 @@
+import hashlib
+import os
 import pickle
 import random
 
 from PIL import Image
 import numpy as np
-from collections import Counter
+from collections import Counter, OrderedDict
 from random import shuffle
 
 
@@ -23,79 +25,96 @@ def apply_map(colours, demod_map, symbols=False):
                 out += str(colour)
     return out
 
-# Read in the images
-enc_img = Image.open("EncodedImage.png")
-orig_img = Image.open("time_travel_image.jpg")
-# Add in an alpga channel to the original image. We should probably have that in already
-orig_img.putalpha(255)
-# Add in
 
-# Convert to arrays
-enc_img = np.array(enc_img, dtype=np.int16)
-orig_img = np.array(orig_img, dtype=np.int16)
+def load_images(enc_fn, orig_fn):
+    """
+    Reads in the encoded and original images and returns them as int16 RGBA arrays
+    """
+    enc_img = Image.open(enc_fn)
+    orig_img = Image.open(orig_fn)
+    # Add in an alpga channel to the original image. We should probably have that in already
+    orig_img.putalpha(255)
+
+    # Convert to arrays
+    enc_img = np.array(enc_img, dtype=np.int16)
+    orig_img = np.array(orig_img, dtype=np.int16)
+
+    return enc_img, orig_img
+
+
+def find_diff(enc_img, orig_img):
+    """
+    Finds the pixels that differ between the two image arrays and returns the differences as a list of colours
+    """
+    mask = np.any(enc_img != orig_img, axis=2)
+    diff = abs(enc_img[mask] - orig_img[mask])
+
+    return diff.tolist()
 
 
-# Find the difference between the two
-mask = np.any(enc_img != orig_img, axis=2)
-diff = abs(enc_img[mask] - orig_img[mask])
-diff = diff.tolist()
+if __name__ == "__main__":
+    # Read in the images
+    enc_img, orig_img = load_images("EncodedImage.png", "time_travel_image.jpg")
 
+    # Find the difference between the two
+    diff = find_diff(enc_img, orig_img)
 
-# Cool function to count up the occurrences of the colours. The map(tuple) bit is to convert
-# the list to tuples.
-diff_counted = Counter(map(tuple, diff))
 
-# The most common colour is probably a space
-# Lets make a test dictionary and try to just solve it by hand
-test_dict = {(1, 0, 0, 7): " ",
-             (2, 0, 0, 19): "e"}
+    # Cool function to count up the occurrences of the colours. The map(tuple) bit is to convert
+    # the list to tuples.
+    diff_counted = Counter(map(tuple, diff))
 
+    # The most common colour is probably a space
+    # Lets make a test dictionary and try to just solve it by hand
+    test_dict = {(1, 0, 0, 7): " ",
+                 (2, 0, 0, 19): "e"}
 
-apply_map(diff, test_dict, symbols=False)
 
-# Looks kind of like text
+    apply_map(diff, test_dict, symbols=False)
 
-# there's a 3 digit word ending in e, that's probably 'the'
-test_dict = {(1, 0, 0, 7): " ",
-             (2, 0, 0, 19): "e",
-             (4, 0, 0, 4): "h"}
-print(apply_map(diff, test_dict, symbols=False))
+    # Looks kind of like text
 
-# Add in the 't'
-test_dict = {(1, 0, 0, 7): " ",
-             (2, 0, 0, 19): "e",
-             (2, 0, 0, 22): "h",
-             (3, 0, 0, 9): "t"}
-print(apply_map(diff, test_dict, symbols=False))
+    # there's a 3 digit word ending in e, that's probably 'the'
+    test_dict = {(1, 0, 0, 7): " ",
+                 (2, 0, 0, 19): "e",
+                 (4, 0, 0, 4): "h"}
+    print(apply_map(diff, test_dict, symbols=False))
 
-# we have 'the'!
+    # Add in the 't'
+    test_dict = {(1, 0, 0, 7): " ",
+                 (2, 0, 0, 19): "e",
+                 (2, 0, 0, 22): "h",
+                 (3, 0, 0, 9): "t"}
+    print(apply_map(diff, test_dict, symbols=False))
 
+    # we have 'the'!
 
-# I see a h😹😹 the first 😹 is ether a i or o  i guess
-test_dict = {(1, 0, 0, 7): " ",
-             (2, 0, 0, 19): "e",
-             (2, 0, 0, 22): "h",
-             (3, 0, 0, 9): "t",
-             (2, 0, 0, 15): "a"}
 
-print(apply_map(diff, test_dict, symbols=False))
+    # I see a h😹😹 the first 😹 is ether a i or o  i guess
+    test_dict = {(1, 0, 0, 7): " ",
+                 (2, 0, 0, 19): "e",
+                 (2, 0, 0, 22): "h",
+                 (3, 0, 0, 9): "t",
+                 (2, 0, 0, 15): "a"}
 
-# a looks right
-# I see a ha😹 that's probably a d I guess
-test_dict = {(1, 0, 0, 7): " ",
-             (2, 0, 0, 19): "e",
-             (2, 0, 0, 22): "h",
-             (3, 0, 0, 9): "t",
-             (2, 0, 0, 15): "a",
-             (2, 0, 0, 28): "d"}
+    print(apply_map(diff, test_dict, symbols=False))
 
-print(apply_map(diff, test_dict, symbols=False))
+    # a looks right
+    # I see a ha😹 that's probably a d I guess
+    test_dict = {(1, 0, 0, 7): " ",
+                 (2, 0, 0, 19): "e",
+                 (2, 0, 0, 22): "h",
+                 (3, 0, 0, 9): "t",
+                 (2, 0, 0, 15): "a",
+                 (2, 0, 0, 28): "d"}
 
-# And so on... But this is too much work! I didn't get into programming to work
-# This is basically a substitution cipher - we have swapped letters for colours
+    print(apply_map(diff, test_dict, symbols=False))
 
-# (Of course I know ahead of time that 1 colour = 1 letter, but that would always be my first guess anyway, and
-# can be figured out pretty easily (just by swapping " " into the most common letter and looking at the result))
+    # And so on... But this is too much work! I didn't get into programming to work
+    # This is basically a substitution cipher - we have swapped letters for colours
+
+    # (Of course I know ahead of time that 1 colour = 1 letter, but that would always be my first guess anyway, and
+    # can be figured out pretty easily (just by swapping " " into the most common letter and looking at the result))
 
 # Lets instead write a program to solve the cipher
 
@@ -212,65 +231,228 @@ def randomness(stop_counter, max_count):
     return n
 
 
-# I couldn't find any letter frequency lists online that included space, so I quickly figured out the frequencies
-# from Mary Shelly's Frankenstein. They look pretty close to the ones online
-with open("bigram_freqs.pkl", 'rb') as f:
-    text_freqs = pickle.load(f)
+class FitnessCache:
+    """
+    Remembers the fitness of keys that have already been scored. A few random swaps of the best key often land on a
+    key we've seen before (or swap straight back to the best key), so there's no point decrypting and counting
+    bigrams all over again. Keeps the most recently used maxsize keys and counts hits, misses and no-op swaps
+    """
+    def __init__(self, colours, maxsize=10000):
+        # calc_fit only looks at the colours in the message, so their letters (in a fixed order) are all that's
+        # needed to tell two keys apart. Swapping two padding colours from make_key gives the same hash
+        self.colours = sorted(set(map(tuple, colours)))
+        # The letters alone don't say which message they were scored against, so remember that too
+        self.fingerprint = message_fingerprint(colours)
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.noops = 0
+
+    def key_hash(self, key):
+        """
+        Packs the key's letters for the message colours into a short string
+        """
+        return ''.join([key.get(colour, '') for colour in self.colours])
+
+    def fitness(self, key, colours, language_freqs, key_hash=None):
+        """
+        Returns 1 - calc_fit for the key, only calculating it if the key isn't in the cache
+        """
+        if key_hash is None:
+            key_hash = self.key_hash(key)
+
+        if key_hash in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key_hash)
+            return self.cache[key_hash]
+
+        self.misses += 1
+        fitness = 1 - calc_fit(key, colours, language_freqs)
+        self.cache[key_hash] = fitness
+
+        # Drop the least recently used key
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+        return fitness
+
+
+def message_fingerprint(colours):
+    """
+    Hashes the colours of a message in order, so a checkpoint can be matched to the message it came from. Two
+    messages using the same letters in a different order get different fingerprints
+    """
+    return hashlib.sha1(np.asarray(colours, dtype=np.int16).tobytes()).hexdigest()
+
+
+def save_checkpoint(fn, key, fitness, stop_counter, iteration, fingerprint, cache_counts=(0, 0, 0)):
+    """
+    Writes the solver state to file. The key is stored as its colours and a string of letters (in dict order, since
+    swap_values reorders the dict and that order feeds the next swaps), along with the numpy RNG state so a resumed
+    run makes exactly the same swaps as an uninterrupted one. cache_counts is the fitness cache's
+    (hits, misses, noops) so the totals carry on after a resume
+    """
+    state = {"fingerprint": fingerprint,
+             "colours": [i for i in key.keys()],
+             "letters": ''.join(key.values()),
+             "fitness": fitness,
+             "stop_counter": stop_counter,
+             "iteration": iteration,
+             "rng_state": np.random.get_state(),
+             "cache_counts": tuple(cache_counts)}
+
+    # Write to a temporary file and then swap it in, so a job killed mid-write leaves the old checkpoint intact
+    tmp_fn = fn + ".tmp"
+    with open(tmp_fn, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_fn, fn)
+
+
+def load_checkpoint(fn, fingerprint):
+    """
+    Reads in a checkpoint written by save_checkpoint and restores the RNG. Returns the key, fitness, stop counter,
+    the iteration to carry on from and the cache counts, or None if the checkpoint is for a different message
+    """
+    with open(fn, 'rb') as f:
+        state = pickle.load(f)
 
-alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZ !,." # think that's all
-colours = diff      # the different pixels that we found before
-guesses = {(1, 0, 0, 7): " ", (2, 0, 0, 19): "E"}
+    if state.get("fingerprint") != fingerprint:
+        return None
 
+    key = {tuple(colour): letter for colour, letter in zip(state["colours"], state["letters"])}
+    np.random.set_state(state["rng_state"])
 
-# 1. Construct an initial guess of the key
-# 2. Use this key to decrypt the message and calculate how much close the decrypted text is to english
-#    Jacobsen uses a digram (two-letter) frequency table to do this. I'm just going to try one letter
+    return key, state["fitness"], state["stop_counter"], state["iteration"], state.get("cache_counts", (0, 0, 0))
 
-# 3. Swap of the elements in the key
-# 4. Again calculate how close the decryted message is to english and if it's closer store the new key
-# 5. Repeat from step 3 until the key hasn't changed for some number of cycles
 
-# Make a key
-key = make_key(alphabet, colours, guesses=guesses)
-best_key = key.copy()
+def crack(colours, language_freqs, key, max_iterations=40000, max_count=5000,
+          checkpoint_file=None, checkpoint_every=1000, resume=False, verbose=True, cache=None):
+    """
+    Hill climbs from the starting key until the key hasn't improved for max_count cycles. If a checkpoint_file is
+    given the state is saved every checkpoint_every iterations, and with resume=True an existing checkpoint is
+    carried on from instead of the starting key. verbose=False turns off the progress prints. Pass in a
+    FitnessCache made for the same colours to read its hit/miss counts afterwards, otherwise a new one is used.
+    After a resume the counts cover the whole crack, but the cache itself starts empty again
+    """
+    if cache is None:
+        cache = FitnessCache(colours)
+    elif cache.fingerprint != message_fingerprint(colours):
+        raise ValueError("FitnessCache was made for a different message")
 
+    fingerprint = message_fingerprint(colours)
 
-# Calculate the fitness
-best_fitness = 1 - calc_fit(key, colours, text_freqs)
+    state = None
+    if resume and checkpoint_file and os.path.exists(checkpoint_file):
+        state = load_checkpoint(checkpoint_file, fingerprint)
+        if state is None and verbose:
+            print(f"{checkpoint_file} is for a different message, starting from scratch")
 
-# Cycles to stop
-stop_counter = 0
-max_count = 5000
+    if state:
+        best_key, best_fitness, stop_counter, start, (cache.hits, cache.misses, cache.noops) = state
+        if verbose:
+            print(f"Resuming from iteration {start} Best fitness: {best_fitness:.2f}")
 
+    else:
+        best_key = key.copy()
+        # Calculate the fitness
+        best_fitness = cache.fitness(key, colours, language_freqs)
+        # Cycles to stop
+        stop_counter = 0
+        start = 0
 
-for i in range(40000):
-    key = best_key.copy()
+    best_hash = cache.key_hash(best_key)
 
-    # It's kind of getting stuck in local minima, so let's input some randomness to the swap values
-    # function
-    n = randomness(stop_counter, max_count)
+    for i in range(start, max_iterations):
+        if stop_counter >= max_count:
+            break
 
-    for j in range(n):
-        swap_values(key)
+        key = best_key.copy()
 
-    new_fitness = 1 - calc_fit(key, colours, text_freqs)
+        # It's kind of getting stuck in local minima, so let's input some randomness to the swap values
+        # function
+        n = randomness(stop_counter, max_count)
 
-    if new_fitness > best_fitness:
-        best_key = key.copy()
-        best_fitness = new_fitness
-        stop_counter = 0
-        bad_swap_list = []
+        for j in range(n):
+            swap_values(key)
+
+        key_hash = cache.key_hash(key)
+
+        # The swaps cancelled each other out, so it's the same key as before
+        if key_hash == best_hash:
+            cache.noops += 1
+            new_fitness = best_fitness
+        else:
+            new_fitness = cache.fitness(key, colours, language_freqs, key_hash)
+
+        if new_fitness > best_fitness:
+            best_key = key.copy()
+            best_fitness = new_fitness
+            best_hash = key_hash
+            stop_counter = 0
+
+        else:
+            stop_counter += 1
+
+        if verbose and i % 500 == 0:
+            print(f"Iteration: {i} New fitness: {new_fitness:.2f} Best fitness: {best_fitness:.2f}")
+
+        # Iteration i is finished, so a resumed run should pick up at i + 1
+        if checkpoint_file and (i + 1) % checkpoint_every == 0:
+            save_checkpoint(checkpoint_file, best_key, best_fitness, stop_counter, i + 1, fingerprint,
+                            (cache.hits, cache.misses, cache.noops))
 
     else:
-        stop_counter += 1
+        i = max_iterations
+
+    if checkpoint_file:
+        save_checkpoint(checkpoint_file, best_key, best_fitness, stop_counter, i, fingerprint,
+                        (cache.hits, cache.misses, cache.noops))
+
+    if verbose:
+        print(f"Fitness cache hits: {cache.hits} misses: {cache.misses} no-op swaps: {cache.noops}")
+
+    return best_key, best_fitness
+
+
+if __name__ == "__main__":
+    # I couldn't find any letter frequency lists online that included space, so I quickly figured out the frequencies
+    # from Mary Shelly's Frankenstein. They look pretty close to the ones online
+    with open("bigram_freqs.pkl", 'rb') as f:
+        text_freqs = pickle.load(f)
+
+    alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZ !,." # think that's all
+    colours = diff      # the different pixels that we found before
+    guesses = {(1, 0, 0, 7): " ", (2, 0, 0, 19): "E"}
+
+
+    # 1. Construct an initial guess of the key
+    # 2. Use this key to decrypt the message and calculate how much close the decrypted text is to english
+    #    Jacobsen uses a digram (two-letter) frequency table to do this. I'm just going to try one letter
+
+    # 3. Swap of the elements in the key
+    # 4. Again calculate how close the decryted message is to english and if it's closer store the new key
+    # 5. Repeat from step 3 until the key hasn't changed for some number of cycles
 
-    if i % 500 == 0:
-        print(f"Iteration: {i} New fitness: {new_fitness:.2f} Best fitness: {best_fitness:.2f}")
+    # Make a key
+    key = make_key(alphabet, colours, guesses=guesses)
 
-    if stop_counter >= max_count:
-        break
+    # Long messages can take a while, so save progress as we go. Set RESUME to carry on from the checkpoint if the
+    # job got killed part way through (a checkpoint for a different message gets ignored)
+    CHECKPOINT_FILE = "solver_checkpoint.pkl"
+    CHECKPOINT_EVERY = 1000
+    RESUME = False
 
-print(apply_map(colours, best_key))
+    best_key, best_fitness = crack(colours, text_freqs, key,
+                                   max_iterations=40000,
+                                   max_count=5000,
+                                   checkpoint_file=CHECKPOINT_FILE,
+                                   checkpoint_every=CHECKPOINT_EVERY,
+                                   resume=RESUME)
 
-# Well that pretty much works! I'm calling that a win
+    print(apply_map(colours, best_key))
 
+    # Well that pretty much works! I'm calling that a win